@@ -1,18 +1,40 @@
 import streamlit as st
 import pandas as pd
+import numpy as np
+import threading
+import time
 from datetime import date
 import gspread
+from gspread.utils import absolute_range_name
 from google.oauth2.service_account import Credentials
 
 # ---------- CONFIG ----------
 COLUMNS = ["date", "category", "description", "amount",
            "payment_method", "frequency", "notes"]
+TEXT_COLUMNS = ["category", "description", "payment_method",
+                "frequency", "notes"]
+
+# Queued rows are written to the sheet once this many are pending
+PENDING_FLUSH_SIZE = 10
+# ...or once the oldest queued row has waited this long (seconds)
+PENDING_MAX_AGE = 60
 
 SCOPE = [
     "https://www.googleapis.com/auth/spreadsheets",
     "https://www.googleapis.com/auth/drive",
 ]
 
+# Day zero for Google Sheets serial date numbers
+SHEETS_EPOCH = pd.Timestamp("1899-12-30")
+# Serial number of 9999-12-31, the last date Sheets can hold
+SHEETS_MAX_SERIAL = 2958465
+
+# Shared read-only result for an empty sheet; same column order as a
+# loaded frame (add_month_column runs before add_paise_column)
+_EMPTY_DF = pd.DataFrame(
+    columns=[c for c in COLUMNS if c != "amount"] + ["month", "amount_paise"]
+).astype({"date": "datetime64[ns]", "amount_paise": "int64"})
+
 
 # ---------- GOOGLE SHEETS HELPERS ----------
 
@@ -29,30 +51,15 @@ def get_worksheet():
     ws = sh.sheet1
 
     # Do NOT trust what is there; just ensure header in A1:G1
-    values = ws.get_all_values()
-    if not values:
-        # completely empty sheet
-        ws.update("A1:G1", [COLUMNS])
-    else:
-        # force header to be correct
+    header = ws.row_values(1)
+    if header != COLUMNS:
+        # empty sheet or wrong header
         ws.update("A1:G1", [COLUMNS])
 
     return ws
 
 
 def add_expense(date_val, category, desc, amount, payment_method, frequency, notes):
-    ws = get_worksheet()
-
-    # Get existing values to know next row index
-    values = ws.get_all_values()
-    if not values:
-        # should not happen because get_worksheet sets header,
-        # but just in case:
-        ws.update("A1:G1", [COLUMNS])
-        next_row = 2
-    else:
-        next_row = len(values) + 1  # next empty row
-
     # Build row exactly matching A..G
     row = [
         str(date_val),
@@ -64,68 +71,194 @@ def add_expense(date_val, category, desc, amount, payment_method, frequency, not
         notes or "",
     ]
 
-    # FORCE write to columns A..G of that row
-    ws.update(f"A{next_row}:G{next_row}", [row])
+    # Queue locally; rows reach the sheet in bursts via flush_pending
+    pending = st.session_state.setdefault("pending", [])
+    if not pending:
+        st.session_state["pending_since"] = time.monotonic()
+    pending.append(row)
 
+    if len(pending) >= PENDING_FLUSH_SIZE or pending_age() >= PENDING_MAX_AGE:
+        flush_pending()
+        return True
+    return False
 
-def get_expenses(start_date=None, end_date=None, category=None):
-    ws = get_worksheet()
 
-    values = ws.get_all_values()
+def pending_age():
+    if not st.session_state.get("pending"):
+        return 0.0
+    return time.monotonic() - st.session_state["pending_since"]
 
-    # Nothing in sheet
-    if not values or len(values) == 1:
-        return pd.DataFrame(columns=COLUMNS)
 
-    header = values[0]
-    data_rows = values[1:]
+def flush_pending():
+    pending = st.session_state.get("pending")
+    if not pending:
+        return
 
-    # If somehow header is wrong, treat all rows as data
-    normalized_header = [str(x).strip().lower() for x in header]
-    if normalized_header != COLUMNS:
-        data_rows = values  # ignore header row
-        header = COLUMNS
-    else:
-        header = COLUMNS
-
-    # Normalise rows to correct length
-    normalized_rows = []
-    for row in data_rows:
-        row = list(row)
-        if len(row) < len(COLUMNS):
-            row = row + [""] * (len(COLUMNS) - len(row))
+    ws = get_worksheet()
+    # Seed the store before appending so the new rows are not loaded twice
+    store = get_expense_store(st.secrets["google_sheets"]["sheet_id"])
+
+    # Single values.append POST for the whole burst; Sheets finds the
+    # next empty row server-side
+    ws.spreadsheet.values_append(
+        absolute_range_name(ws.title, "A1:G1"),
+        # RAW so free-text fields are never parsed as formulas, numbers or
+        # dates; the date goes in as ISO text, which the loader parses
+        {"valueInputOption": "RAW", "insertDataOption": "INSERT_ROWS"},
+        {"values": pending},
+    )
+
+    # Mirror the rows into the local store so reads stay off the network
+    new_rows = pd.DataFrame(pending, columns=COLUMNS)
+    new_rows["date"] = pd.to_datetime(new_rows["date"], format="%Y-%m-%d")
+    add_month_column(new_rows)
+    add_paise_column(new_rows)
+    # The store is shared by every session thread
+    with store["lock"]:
+        if store["df"].empty:
+            store["df"] = new_rows
         else:
-            row = row[:len(COLUMNS)]
-        normalized_rows.append(row)
+            store["df"] = pd.concat([store["df"], new_rows], ignore_index=True)
+
+    pending.clear()
+    st.session_state.pop("pending_since", None)
+
 
-    if not normalized_rows:
-        return pd.DataFrame(columns=COLUMNS)
+def fetch_ranges(ws, ranges):
+    # One batchGet round-trip for any number of ranges on this worksheet,
+    # returned as {range: rows} in the order requested
+    resp = ws.spreadsheet.values_batch_get(
+        [absolute_range_name(ws.title, r) for r in ranges],
+        params={
+            "valueRenderOption": "UNFORMATTED_VALUE",
+            "dateTimeRenderOption": "SERIAL_NUMBER",
+        },
+    )
+    value_ranges = resp.get("valueRanges", [])
+    return {r: vr.get("values", []) for r, vr in zip(ranges, value_ranges)}
 
-    df = pd.DataFrame(normalized_rows, columns=COLUMNS)
 
-    # Types
-    df["date"] = pd.to_datetime(df["date"], errors="coerce")
-    df["amount"] = pd.to_numeric(df["amount"], errors="coerce").fillna(0.0)
+def add_paise_column(df):
+    # Amounts are held as whole paise so totals add up exactly; the sheet
+    # itself stays in rupees
+    df["amount_paise"] = np.rint(df["amount"].to_numpy() * 100).astype(np.int64)
+    df.drop(columns=["amount"], inplace=True)
+
+
+def add_month_column(df):
+    # "YYYY-MM" labels for the dashboard, computed once at load time;
+    # truncating to datetime64[M] avoids building Period objects
+    df["month"] = df["date"].to_numpy().astype("datetime64[M]").astype(str)
+
+
+def _load_raw_df():
+    ws = get_worksheet()
+
+    # Skip the header row and let Sheets send raw numbers instead of
+    # display strings (amounts as floats, dates as serial day numbers)
+    values = fetch_ranges(ws, ["A2:G"])["A2:G"]
+
+    # Nothing in sheet
+    if not values:
+        return _EMPTY_DF
+
+    # Normalise rows to correct length (trailing empty cells are omitted);
+    # the constructor pads ragged rows and reindex trims/pads the columns
+    df = pd.DataFrame(values).reindex(columns=range(len(COLUMNS)))
+    df.columns = COLUMNS
+    df[TEXT_COLUMNS] = df[TEXT_COLUMNS].fillna("")
+
+    # Types: dates typed into the sheet arrive as serial day numbers, while
+    # rows appended by the app hold ISO text and are parsed as strings
+    serial = pd.to_numeric(df["date"], errors="coerce")
+    # Numbers outside real Sheets dates (20240105 typed as a number, inf,
+    # 1e300) become NaT and are dropped below
+    in_range = serial.where(serial.between(0, SHEETS_MAX_SERIAL))
+    dates = pd.to_datetime(
+        in_range, unit="D", origin=SHEETS_EPOCH, errors="coerce"
+    )
+    df["date"] = dates.fillna(
+        pd.to_datetime(
+            df["date"].where(serial.isna()),
+            format="%Y-%m-%d",
+            errors="coerce",
+            cache=True,
+        )
+    )
+    # Amounts arrive as floats; only fall back to coercion when blank or
+    # text cells made the column object dtype
+    amount = df["amount"]
+    if amount.dtype != np.float64:
+        amount = pd.to_numeric(amount, errors="coerce")
+    df["amount"] = amount.fillna(0.0)
 
     # Drop rows with no valid date
     df = df.dropna(subset=["date"])
+    add_month_column(df)
+    add_paise_column(df)
+
+    return df
+
+
+@st.cache_resource(show_spinner=False)
+def get_expense_store(sheet_id):
+    # Process-local copy of the sheet, seeded once and then kept in sync
+    # by flush_pending; sheet_id only keys the cache
+    return {"df": _load_raw_df(), "lock": threading.Lock()}
+
+
+def get_expenses(start_date=None, end_date=None, category=None):
+    df = get_expense_store(st.secrets["google_sheets"]["sheet_id"])["df"]
+
+    if df.empty:
+        return df
 
-    # Filters
+    # Filters: build one combined mask, then slice once
+    mask = np.ones(len(df), dtype=bool)
     if start_date:
-        df = df[df["date"] >= pd.to_datetime(start_date)]
+        mask &= df["date"].to_numpy() >= np.datetime64(pd.to_datetime(start_date))
     if end_date:
-        df = df[df["date"] <= pd.to_datetime(end_date)]
+        mask &= df["date"].to_numpy() <= np.datetime64(pd.to_datetime(end_date))
     if category and category != "All":
-        df = df[df["category"] == category]
+        mask &= df["category"].to_numpy() == category
+    df = df.loc[mask]
 
     # Latest first
-    df = df.sort_values(by="date", ascending=False)
+    df = df.sort_values(by="date", ascending=False, kind="stable")
 
     return df
 
 
+def to_rupees(df):
+    # Sheet-shaped copy with amount back in rupees, for tables and export
+    return df.assign(amount=df["amount_paise"] / 100)[COLUMNS]
+
+
+@st.cache_data(max_entries=8, show_spinner=False)
+def _df_to_csv_bytes(df):
+    # Keyed on the frame's contents, so unchanged filters reuse the bytes
+    return to_rupees(df).to_csv(index=False).encode("utf-8")
+
+
 # ---------- STREAMLIT UI ----------
 
+@st.fragment(run_every=15)
+def auto_flush_pending():
+    # Reruns on its own timer, so a queue cannot sit unsynced while the
+    # user stays on one page
+    if pending_age() >= PENDING_MAX_AGE:
+        flush_pending()
+        st.rerun()
+
+
+def show_pending(slot):
+    count = len(st.session_state.get("pending", []))
+    if count:
+        slot.caption(f"Pending ({count})")
+    else:
+        slot.empty()
+
+
 def main():
     st.set_page_config(page_title="Fitness Expense Tracker", page_icon="💪")
 
@@ -134,6 +267,20 @@ def main():
     menu = ["Add Expense", "View Expenses", "Dashboard"]
     choice = st.sidebar.selectbox("Navigate", menu)
 
+    # Leaving a page writes out anything still queued
+    if st.session_state.get("page") != choice:
+        st.session_state["page"] = choice
+        flush_pending()
+
+    pending_badge = st.sidebar.empty()
+    if st.sidebar.button("⬆️ Sync to sheet"):
+        flush_pending()
+    show_pending(pending_badge)
+    auto_flush_pending()
+
+    if st.sidebar.button("🔄 Refresh from sheet"):
+        get_expense_store.clear()
+
     if choice == "Add Expense":
         st.header("➕ Add Expense")
 
@@ -165,9 +312,17 @@ def main():
 
         if st.button("Save Expense"):
             if amount > 0:
-                add_expense(exp_date, category, description,
-                            amount, payment_method, frequency, notes)
-                st.success("Expense saved ✅ (stored in Google Sheets)")
+                synced = add_expense(exp_date, category, description,
+                                     amount, payment_method, frequency, notes)
+                show_pending(pending_badge)
+                if synced:
+                    st.success("Expense saved ✅ (stored in Google Sheets)")
+                else:
+                    count = len(st.session_state["pending"])
+                    st.info(
+                        f"Queued ({count}), not yet in Google Sheets; "
+                        "click Sync to save now."
+                    )
             else:
                 st.error("Amount must be greater than 0.")
 
@@ -201,12 +356,12 @@ def main():
 
         if not df.empty:
             st.subheader("Results")
-            st.dataframe(df)
+            st.dataframe(to_rupees(df))
 
-            total = df["amount"].sum()
-            st.write(f"**Total in this view: ₹{total:,.2f}**")
+            total_paise = df["amount_paise"].sum()
+            st.write(f"**Total in this view: ₹{total_paise / 100:,.2f}**")
 
-            csv = df.to_csv(index=False).encode("utf-8")
+            csv = _df_to_csv_bytes(df)
             st.download_button(
                 "⬇️ Download as CSV",
                 data=csv,
@@ -224,22 +379,28 @@ def main():
             st.info("No data yet. Add some expenses first.")
             return
 
-        df_dash = df.copy()
-        df_dash["month"] = df_dash["date"].dt.to_period("M").astype(str)
+        # One pass over the rows; both charts roll up the small result.
+        # observed=True guards against a Cartesian reindex should either
+        # key ever become a Categorical
+        totals = df.groupby(
+            ["month", "category"], observed=True, sort=False
+        )["amount_paise"].sum()
 
         col1, col2 = st.columns(2)
         with col1:
-            by_month = df_dash.groupby("month")["amount"].sum().reset_index()
+            by_month = (totals.groupby(level=0).sum() / 100).rename("amount")
             st.subheader("Monthly Total Spend")
-            st.bar_chart(by_month.set_index("month"))
+            st.bar_chart(by_month)
 
         with col2:
-            by_cat = df_dash.groupby("category")["amount"].sum().reset_index()
+            by_cat = (
+                totals.groupby(level=1, sort=False).sum() / 100
+            ).rename("amount")
             st.subheader("Spend by Category")
-            st.bar_chart(by_cat.set_index("category"))
+            st.bar_chart(by_cat)
 
         st.subheader("Raw Data")
-        st.dataframe(df)
+        st.dataframe(to_rupees(df))
 
 
 if __name__ == "__main__":